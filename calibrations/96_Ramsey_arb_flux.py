@@ -24,9 +24,7 @@ from iqcc_calibration_tools.qualibrate_config.qualibrate.node import Qualibratio
 from iqcc_calibration_tools.quam_config.components import Quam
 from iqcc_calibration_tools.quam_config.macros import qua_declaration, readout_state, active_reset
 from iqcc_calibration_tools.quam_config.lib.qua_datasets import convert_IQ_to_V
-from iqcc_calibration_tools.analysis.plot_utils import QubitGrid, grid_iter
 from iqcc_calibration_tools.storage.save_utils import fetch_results_as_xarray, load_dataset, get_node_id, save_node
-from iqcc_calibration_tools.analysis.fit import fit_oscillation_decay_exp, oscillation_decay_exp, fit_oscillation_decay_gaussian, oscillation_decay_gaussian
 from qualang_tools.results import progress_counter, fetching_tool
 from qualang_tools.loops import from_array
 from qualang_tools.multi_user import qm_session
@@ -34,8 +32,8 @@ from qualang_tools.units import unit
 from qm import SimulationConfig
 from qm.qua import *
 from typing import Literal, Optional, List
-import matplotlib.pyplot as plt
 import numpy as np
+import xarray as xr
 
 
 # %% {Node_parameters}
@@ -48,11 +46,15 @@ class Parameters(NodeParameters):
     max_wait_time_in_ns: int = 5000
     flux_point_joint_or_independent: Literal["joint", "independent"] = "joint"
     use_state_discrimination: bool = True
+    # "none" keeps the XOR parity tracking with the previously measured state instead of resetting the qubit
+    reset_type_thermal_or_active: Literal["none", "thermal", "active"] = "none"
     simulate: bool = False
     simulation_duration_ns: int = 2500
     timeout: int = 100
     load_data_id: Optional[int] = None
     multiplexed: bool = True
+    # Number of joblib workers for the per-qubit gaussian fits, None fits serially
+    fit_n_jobs: Optional[int] = None
 
 node = QualibrationNode(name="96_Ramsey_arb_flux", parameters=Parameters())
 node_id = get_node_id()
@@ -79,19 +81,20 @@ num_qubits = len(qubits)
 # %% {QUA_program}
 n_avg = node.parameters.num_averages  # The number of averages
 # Dephasing time sweep (in clock cycles = 4ns) - minimum is 4 clock cycles
-idle_times = (
-    np.arange(
-        node.parameters.min_wait_time_in_ns,
-        node.parameters.max_wait_time_in_ns,
-        4,
-    )
-    // 4
-).astype(int)
+idle_times = np.arange(
+    node.parameters.min_wait_time_in_ns // 4,
+    node.parameters.max_wait_time_in_ns // 4,
+    1,
+    dtype=np.int32,
+)
 
 
 # Detuning converted into virtual Z-rotations to observe Ramsey oscillation and get the qubit frequency
 detuning = int(1e6 * node.parameters.frequency_detuning_in_mhz)
 flux_point = node.parameters.flux_point_joint_or_independent
+reset_type = node.parameters.reset_type_thermal_or_active  # "none", "active" or "thermal"
+# Virtual Z-rotation (in units of 2pi) accumulated for the given detuning after each idle time, precomputed host-side
+phi_values = ((detuning * 1e-9) * (4 * idle_times)) % 1.0
 
 with program() as ramsey:
     I, I_st, Q, Q_st, n, n_st = qua_declaration(num_qubits=num_qubits)
@@ -103,6 +106,12 @@ with program() as ramsey:
     init_state = [declare(int) for _ in range(num_qubits)]
     state = [declare(int) for _ in range(num_qubits)]
     final_state = [declare(int) for _ in range(num_qubits)]
+    # Sweep tables stored in QUA memory rather than unrolled in the program
+    t_arr = declare(int, value=idle_times.tolist())
+    phi_arr = declare(fixed, value=phi_values.tolist())
+    idx = declare(int)  # QUA variable indexing the sweep tables and the accumulators
+    # Integer accumulators of the measured state for each idle time, averaged host-side
+    state_sum = [declare(int, size=len(idle_times)) for _ in range(num_qubits)]
     state_st = [declare_stream() for _ in range(num_qubits)]
 
     for i, qubit in enumerate(qubits):
@@ -112,26 +121,39 @@ with program() as ramsey:
         
         with for_(n, 0, n < n_avg, n + 1):
             save(n, n_st)
-            with for_each_(t, idle_times):
-                # Rotate the frame of the second x90 gate to implement a virtual Z-rotation
-                assign(phi,   Cast.mul_fixed_by_int(detuning * 1e-9, 4 * t))
+            with for_(idx, 0, idx < len(idle_times), idx + 1):
+                assign(t, t_arr[idx])
+                assign(phi, phi_arr[idx])
+                # Initialize the qubits
+                if reset_type == "active":
+                    active_reset(qubit)
+                elif reset_type == "thermal":
+                    qubit.wait(qubit.thermalization_time * u.ns)
                 qubit.align()
                 # # Strict_timing ensures that the sequence will be played without gaps
                 # with strict_timing_():
                 qubit.xy.play("x90")
                 qubit.xy.wait(t)
+                # Rotate the frame of the second x90 gate to implement a virtual Z-rotation
                 qubit.xy.frame_rotation_2pi(phi)
                 qubit.xy.play("x90")
+                # Undo the virtual Z-rotation so that the rotations do not accumulate
+                qubit.xy.frame_rotation_2pi(-phi)
 
                 # Align the elements to measure after playing the qubit pulse.
                 qubit.align()
                 # Measure the state of the resonators
                 readout_state(qubit, state[i])
-                assign(final_state[i], init_state[i] ^ state[i])
-                save(final_state[i], state_st[i])
-                assign(init_state[i], state[i])
-                # Reset the frame of the qubits in order not to accumulate rotations
-                reset_frame(qubit.xy.name)
+                if reset_type == "none":
+                    # Without reset the qubit starts in the previously measured state, so only the parity is kept
+                    assign(final_state[i], init_state[i] ^ state[i])
+                    assign(init_state[i], state[i])
+                else:
+                    assign(final_state[i], state[i])
+                assign(state_sum[i][idx], state_sum[i][idx] + final_state[i])
+        # Stream the accumulated counts once all the averages are done
+        with for_(idx, 0, idx < len(idle_times), idx + 1):
+            save(state_sum[i][idx], state_st[i])
         # Measure sequentially
         if not node.parameters.multiplexed:
             align()
@@ -139,12 +161,14 @@ with program() as ramsey:
     with stream_processing():
         n_st.save("n")
         for i in range(num_qubits):
-            state_st[i].buffer(len(idle_times)).average().save(f"state{i + 1}")
+            state_st[i].buffer(len(idle_times)).save(f"state{i + 1}")
 
 
 
 # %% {Simulate_or_execute}
 if node.parameters.simulate:
+    import matplotlib.pyplot as plt
+
     # Simulates the QUA program for the specified duration
     simulation_config = SimulationConfig(duration=node.parameters.simulation_duration_ns * 4)  # In clock cycles = 4ns
     job = qmm.simulate(config, ramsey, simulation_config)
@@ -173,184 +197,120 @@ elif node.parameters.load_data_id is None:
             progress_counter(n, n_avg, start_time=results.start_time)
 
 
-# %% {Data_fetching_and_dataset_creation}
-if not node.parameters.simulate:
-    if node.parameters.load_data_id is None:
-        # Fetch the data from the OPX and convert it into a xarray with corresponding axes (from most inner to outer loop)
-        ds = fetch_results_as_xarray(job.result_handles, qubits, {"time": idle_times})
-
-        # Add the absolute time to the dataset
-        ds = ds.assign_coords({"time": (["time"], 4 * idle_times)})
-        ds.time.attrs["long_name"] = "idle_time"
-        ds.time.attrs["units"] = "ns"
-    else:
-        node = node.load_from_id(node.parameters.load_data_id)
-        ds = node.results["ds"]
-    # Add the dataset to the node
-    node.results = {"ds": ds}
-
-
-    # %% {Data_analysis}
-    # Fit the Ramsey oscillations based on the qubit state or the 'I' quadrature
-    fit = fit_oscillation_decay_exp(ds.state, "time")
+# %% {Analysis_helpers}
+def _analyze(ds, fit_fn, model_fn, label, **fit_kwargs):
+    """Fit the Ramsey oscillations with `fit_fn`, evaluate `model_fn` on the fit and return (fit, fitted, fit_results)."""
+    # Fit the Ramsey oscillations based on the qubit state
+    fit = fit_fn(ds.state, "time", **fit_kwargs)
     fit.attrs = {"long_name": "time", "units": "µs"}
-    fitted = oscillation_decay_exp(
-        ds.time,
-        fit.sel(fit_vals="a"),
-        fit.sel(fit_vals="f"),
-        fit.sel(fit_vals="phi"),
-        fit.sel(fit_vals="offset"),
-        fit.sel(fit_vals="decay"),
-    )
+    # Split the fit parameters into named variables once instead of selecting them one by one along fit_vals
+    fit_ds = fit.to_dataset(dim="fit_vals")
+    fitted = model_fn(ds.time, fit_ds.a, fit_ds.f, fit_ds.phi, fit_ds.offset, fit_ds.decay)
     # TODO: add meaningful comments
-    frequency = fit.sel(fit_vals="f")
+    frequency = fit_ds.f
     frequency.attrs = {"long_name": "frequency", "units": "MHz"}
 
-    decay = fit.sel(fit_vals="decay")
-    decay.attrs = {"long_name": "decay", "units": "nSec"}
-
     frequency = frequency.where(frequency > 0, drop=True)
 
-    decay = fit.sel(fit_vals="decay")
+    decay = fit_ds.decay
     decay.attrs = {"long_name": "decay", "units": "nSec"}
 
-    decay_res = fit.sel(fit_vals="decay_decay")
+    decay_res = fit_ds.decay_decay
     decay_res.attrs = {"long_name": "decay", "units": "nSec"}
 
-    tau = 1 / fit.sel(fit_vals="decay")
+    tau = 1 / decay
     tau.attrs = {"long_name": "T2*", "units": "uSec"}
 
-    tau_error = tau * (np.sqrt(decay_res) / decay)
+    # Computed on the underlying numpy arrays to avoid the intermediate xarray objects
+    tau_error = tau.copy(data=tau.values * (np.sqrt(decay_res.values) / decay.values))
     tau_error.attrs = {"long_name": "T2* error", "units": "uSec"}
 
-    within_detuning = (1e9 * frequency < 2 * detuning) == 1
-    
     freq_offset = frequency
     decay = 1e-9 * tau
     decay_error = 1e-9 * tau_error
 
-    # Save fitting results
-    fit_results = {
-        q.name: {
-            "freq_offset": 1e9 * freq_offset.loc[q.name].values,
-            "decay": decay.loc[q.name].values,
-            "decay_error": decay_error.loc[q.name].values,
-        }
-        for q in qubits
-    }
-    node.results["fit_results"] = fit_results
-    for q in qubits:
-        print(f"Frequency offset for qubit {q.name} : {(fit_results[q.name]['freq_offset']/1e6):.2f} MHz ")
-        print(f"T2* for qubit {q.name} : {1e6*fit_results[q.name]['decay']:.2f} us")
-
-
-    # %% {Plotting}
-    grid = QubitGrid(ds, [q.grid_location for q in qubits])
-    for ax, qubit in grid_iter(grid):
-        ds.loc[qubit].state.plot(
-            ax=ax, x="time", c="C0", marker=".", ms=5.0, ls=""
-        )
-        ax.plot(ds.time, fitted.loc[qubit], c="C1", ls="-", lw=1)
-        ax.set_ylabel("State")
-
-
-        ax.set_xlabel("Idle time [ns]")
-        ax.set_title(qubit["qubit"])
-        ax.text(
-            0.1,
-            0.9,
-            f'T2* = {1e6*fit_results[qubit["qubit"]]["decay"]:.1f} ± {1e6*fit_results[qubit["qubit"]]["decay_error"]:.1f} µs',
-            transform=ax.transAxes,
-            fontsize=10,
-            verticalalignment="top",
-            bbox=dict(facecolor="white", alpha=0.5),
-        )
-        ax.legend()
-    grid.fig.suptitle(f"Ramsey : I vs. idle time \n {date_time} GMT+3 #{node_id} \n multiplexed = {node.parameters.multiplexed}")
-    plt.tight_layout()
-    plt.show()
-    node.results["figure"] = grid.fig
-
-    # %% {Data_analysis}
-    # Fit the Ramsey oscillations based on the qubit state or the 'I' quadrature
-    fit = fit_oscillation_decay_gaussian(ds.state, "time")
-    fit.attrs = {"long_name": "time", "units": "µs"}
-    fitted = oscillation_decay_gaussian(
-        ds.time,
-        fit.sel(fit_vals="a"),
-        fit.sel(fit_vals="f"),
-        fit.sel(fit_vals="phi"),
-        fit.sel(fit_vals="offset"),
-        fit.sel(fit_vals="decay"),
+    # Save fitting results as one dataset indexed by qubit (ordered like `qubits`, the dropped qubits become NaN)
+    names = [q.name for q in qubits]
+    fit_results = xr.Dataset(
+        {
+            "freq_offset": (("qubit",), (1e9 * freq_offset).reindex(qubit=names).values),
+            "decay": (("qubit",), decay.reindex(qubit=names).values),
+            "decay_error": (("qubit",), decay_error.reindex(qubit=names).values),
+        },
+        coords={"qubit": names},
     )
-    # TODO: add meaningful comments
-    frequency = fit.sel(fit_vals="f")
-    frequency.attrs = {"long_name": "frequency", "units": "MHz"}
+    for q, fo, dc in zip(fit_results.qubit.values, fit_results.freq_offset.values, fit_results.decay.values):
+        print(f"Frequency offset ({label}) for qubit {q} : {(fo/1e6):.2f} MHz ")
+        print(f"T2* ({label}) for qubit {q} : {1e6*dc:.2f} us")
 
-    decay = fit.sel(fit_vals="decay")
-    decay.attrs = {"long_name": "decay", "units": "nSec"}
+    return fit, fitted, fit_results
 
-    frequency = frequency.where(frequency > 0, drop=True)
-
-    decay = fit.sel(fit_vals="decay")
-    decay.attrs = {"long_name": "decay", "units": "nSec"}
 
-    decay_res = fit.sel(fit_vals="decay_decay")
-    decay_res.attrs = {"long_name": "decay", "units": "nSec"}
+# %% {Data_fetching_and_dataset_creation}
+if not node.parameters.simulate:
+    # The plotting and fitting modules are only needed past this point, import them lazily to speed up node start-up
+    import matplotlib.pyplot as plt
+    from iqcc_calibration_tools.analysis.plot_utils import QubitGrid, grid_iter
+    from iqcc_calibration_tools.analysis.fit import fit_oscillation_decay_gaussian, oscillation_decay_gaussian
+    from qualibration_libs.analysis import fit_oscillation_decay_exp, oscillation_decay_exp
 
-    tau = 1 / fit.sel(fit_vals="decay")
-    tau.attrs = {"long_name": "T2*", "units": "uSec"}
+    if node.parameters.load_data_id is None:
+        # Fetch the data from the OPX and convert it into a xarray with corresponding axes (from most inner to outer loop)
+        ds = fetch_results_as_xarray(job.result_handles, qubits, {"time": idle_times})
+        # The OPX returns the number of |1> outcomes per idle time, convert it into the averaged state
+        ds["state"] = ds.state / n_avg
 
-    tau_error = tau * (np.sqrt(decay_res) / decay)
-    tau_error.attrs = {"long_name": "T2* error", "units": "uSec"}
+        # Add the absolute time to the dataset
+        ds = ds.assign_coords({"time": (["time"], 4 * idle_times)})
+        ds.time.attrs["long_name"] = "idle_time"
+        ds.time.attrs["units"] = "ns"
+    else:
+        node = node.load_from_id(node.parameters.load_data_id)
+        ds = node.results["ds"]
+    # Add the dataset to the node
+    node.results = {"ds": ds}
 
-    within_detuning = (1e9 * frequency < 2 * detuning) == 1
-    
-    freq_offset = frequency
-    decay = 1e-9 * tau
-    decay_error = 1e-9 * tau_error
 
-    # Save fitting results
-    fit_results = {
-        q.name: {
-            "freq_offset": 1e9 * freq_offset.loc[q.name].values,
-            "decay": decay.loc[q.name].values,
-            "decay_error": decay_error.loc[q.name].values,
-        }
-        for q in qubits
-    }
-    node.results["fit_results"] = fit_results
-    for q in qubits:
-        print(f"Frequency offset for qubit {q.name} : {(fit_results[q.name]['freq_offset']/1e6):.2f} MHz ")
-        print(f"T2* for qubit {q.name} : {1e6*fit_results[q.name]['decay']:.2f} us")
+    # %% {Data_analysis}
+    # Fit the Ramsey oscillations with an exponential and a gaussian decay envelope
+    exp_fit, fitted_exp, fit_results_exp = _analyze(ds, fit_oscillation_decay_exp, oscillation_decay_exp, "exp")
+    # The exponential fit seeds the gaussian one, which then converges in fewer iterations
+    _, fitted_gauss, fit_results_gauss = _analyze(
+        ds, fit_oscillation_decay_gaussian, oscillation_decay_gaussian, "gaussian",
+        initial_guess=exp_fit, n_jobs=node.parameters.fit_n_jobs,
+    )
+    node.results["fit_results_exp"] = fit_results_exp
+    node.results["fit_results_gaussian"] = fit_results_gauss
 
 
     # %% {Plotting}
     grid = QubitGrid(ds, [q.grid_location for q in qubits])
     for ax, qubit in grid_iter(grid):
         ds.loc[qubit].state.plot(
-            ax=ax, x="time", c="C0", marker=".", ms=5.0, ls=""
+            ax=ax, x="time", c="C0", marker=".", ms=5.0, ls="", label="data"
         )
-        ax.plot(ds.time, fitted.loc[qubit], c="C1", ls="-", lw=1)
+        ax.plot(ds.time, fitted_exp.loc[qubit], c="C1", ls="--", lw=1, label="exp fit")
+        ax.plot(ds.time, fitted_gauss.loc[qubit], c="C2", ls="-", lw=1, label="gaussian fit")
         ax.set_ylabel("State")
-
-
         ax.set_xlabel("Idle time [ns]")
         ax.set_title(qubit["qubit"])
+        res_exp = fit_results_exp.sel(qubit)
+        res_gauss = fit_results_gauss.sel(qubit)
         ax.text(
             0.1,
             0.9,
-            f'T2* = {1e6*fit_results[qubit["qubit"]]["decay"]:.1f} ± {1e6*fit_results[qubit["qubit"]]["decay_error"]:.1f} µs',
+            f"T2* (exp) = {1e6*res_exp.decay.item():.1f} ± {1e6*res_exp.decay_error.item():.1f} µs\n"
+            f"T2* (gaussian) = {1e6*res_gauss.decay.item():.1f} ± {1e6*res_gauss.decay_error.item():.1f} µs",
             transform=ax.transAxes,
             fontsize=10,
             verticalalignment="top",
             bbox=dict(facecolor="white", alpha=0.5),
         )
         ax.legend()
-    grid.fig.suptitle(f"Ramsey : I vs. idle time \n {date_time} GMT+3 #{node_id} \n multiplexed = {node.parameters.multiplexed}")
+    grid.fig.suptitle(f"Ramsey : I vs. idle time \n {date_time} GMT+3 #{node_id} \n multiplexed = {node.parameters.multiplexed} reset Type = {node.parameters.reset_type_thermal_or_active}")
     plt.tight_layout()
     plt.show()
-    node.results["figure_gaussian"] = grid.fig
+    node.results["figure"] = grid.fig
 
 
     # %% {Save_results}
@@ -4,6 +4,12 @@ from scipy.optimize import curve_fit
 import numpy as np
 import xarray as xr
 from scipy.fft import fft
+from scipy.signal import hilbert
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:  # joblib is optional, the fits then run serially
+    Parallel = None
 
 
 def fix_initial_value(x, da):
@@ -96,51 +102,100 @@ def oscillation_decay_gaussian(t, a, f, phi, offset, decay):
     return a * np.exp(-t**2 * decay**2) * np.cos(2 * np.pi * f * t + phi) + offset
 
 
-def fit_oscillation_decay_gaussian(da, dim):
-    def get_decay(dat):
-        def oed(d):
-            return guess.oscillation_exp_decay(da[dim], d)
+def _oscillation_decay_gaussian_jac(t, a, f, phi, offset, decay):
+    # Analytic Jacobian of the model with respect to (a, f, phi, offset, decay), used by curve_fit
+    t = np.asarray(t, dtype=np.float64)
+    e = np.exp(-(t**2) * decay**2)
+    c = np.cos(2 * np.pi * f * t + phi)
+    s = np.sin(2 * np.pi * f * t + phi)
+    return np.stack(
+        [e * c, -2 * np.pi * t * a * e * s, -a * e * s, np.ones_like(t), -2 * t**2 * decay * a * e * c], axis=-1
+    )
 
-        return np.apply_along_axis(oed, -1, dat)
 
-    def get_freq(dat):
-        def f(d):
-            return guess.frequency(da[dim], d)
+def _vectorize_in_parallel(apply_fit, n_jobs):
+    """
+    Replacement for `xr.apply_ufunc(..., vectorize=True)` that runs `apply_fit(x, y, *guesses)` for every 1D
+    slice of y (core dimension last) in joblib worker processes.
+    """
 
-        return np.apply_along_axis(f, -1, dat)
+    def vectorized(x, y, *guesses):
+        loop_shape = y.shape[:-1]
+        x = np.broadcast_to(x, y.shape)
+        guesses = [np.broadcast_to(g, loop_shape) for g in guesses]
+        results = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(apply_fit)(x[idx], y[idx], *(g[idx] for g in guesses)) for idx in np.ndindex(loop_shape)
+        )
+        return np.stack(results).reshape(loop_shape + (-1,))
 
-    def get_amp(dat):
-        max_ = np.max(dat, axis=-1)
-        min_ = np.min(dat, axis=-1)
-        return (max_ - min_) / 2
+    return vectorized
 
-    decay_guess = xr.apply_ufunc(get_decay, da, input_core_dims=[[dim]]).rename("decay guess")
-    freq_guess = xr.apply_ufunc(get_freq, da, input_core_dims=[[dim]]).rename("freq guess")
-    amp_guess = xr.apply_ufunc(get_amp, da, input_core_dims=[[dim]]).rename("amp guess")
+
+def guess_oscillation_decay(da, dim):
+    """
+    Initial guess of a decaying oscillation, computed at once for all the slices of `da` along `dim`.
+
+    The frequency and phase come from the dominant rFFT bin, the decay from a linear fit of the log of the Hilbert
+    envelope. Returns a DataArray with the "a", "f", "phi", "offset" and "decay" fit_vals.
+    """
+    t = da[dim].values.astype(float)
+
+    def get_guess(y):
+        offset = y.mean(axis=-1, keepdims=True)
+        y0 = y - offset
+        spectrum = np.fft.rfft(y0, axis=-1)
+        # Skip the DC bin when looking for the dominant frequency
+        peak = np.argmax(np.abs(spectrum[..., 1:]), axis=-1)[..., None] + 1
+        f = np.fft.rfftfreq(y.shape[-1], d=t[1] - t[0])[peak]
+        # Phase of the dominant bin, referred to t = 0
+        phi = np.angle(np.take_along_axis(spectrum, peak, axis=-1)) - 2 * np.pi * f * t[0]
+        phi = (phi + np.pi) % (2 * np.pi) - np.pi
+        envelope = np.abs(hilbert(y0, axis=-1)).reshape(-1, y.shape[-1])
+        slope = np.polyfit(t, np.log(envelope + 1e-12).T, 1)[0].reshape(y.shape[:-1] + (1,))
+        a = (np.max(y, axis=-1, keepdims=True) - np.min(y, axis=-1, keepdims=True)) / 2
+        return np.concatenate([a, f, phi, offset, np.abs(slope)], axis=-1)
+
+    guess_res = xr.apply_ufunc(get_guess, da, input_core_dims=[[dim]], output_core_dims=[["fit_vals"]])
+    return guess_res.assign_coords(fit_vals=("fit_vals", ["a", "f", "phi", "offset", "decay"]))
+
+
+def fit_oscillation_decay_gaussian(da, dim, initial_guess=None, n_jobs=None):
+    guess_ = guess_oscillation_decay(da, dim)
+    # Seed the fit with a previous fit result (e.g. fit_oscillation_decay_exp) when provided, falling back to the
+    # FFT-based guess wherever that fit failed
+    if initial_guess is not None:
+        guess_ = initial_guess.sel(fit_vals=guess_.fit_vals).fillna(guess_)
+    amp_guess, freq_guess, phi_guess, offset_guess, decay_guess = (
+        guess_.sel(fit_vals=name, drop=True) for name in ["a", "f", "phi", "offset", "decay"]
+    )
 
     def apply_fit(x, y, a, f, phi, offset, decay):
         try:
-            fit, residuals = curve_fit(oscillation_decay_gaussian, x, y, p0=[a, f, phi, offset, decay])
+            fit, residuals = curve_fit(
+                oscillation_decay_gaussian, x, y, p0=[a, f, phi, offset, decay], jac=_oscillation_decay_gaussian_jac
+            )
             return np.array(fit.tolist() + np.array(residuals).flatten().tolist())
-        except RuntimeError as e:
-            print(f"{a=}, {f=}, {phi=}, {offset=}, {decay=}")
-            plt.plot(x, oscillation_decay_gaussian(x, a, f, phi, offset, decay))
-            plt.plot(x, y)
-            plt.show()
-            # raise e
-
+        except RuntimeError:
+            # Return a NaN row (5 parameters + 5x5 covariance) so that a failed slice does not break the stacking,
+            # also when running in a headless joblib worker
+            print(f"Fit failed for {a=}, {f=}, {phi=}, {offset=}, {decay=}")
+            return np.full(30, np.nan)
+
+    # The fits of the different slices (e.g. qubits) are independent, so they can be spread over n_jobs processes.
+    # A single fit only takes ~1 ms, so this only pays off for many slices: keep n_jobs=None (serial) otherwise.
+    parallel = n_jobs is not None and Parallel is not None
     fit_res = xr.apply_ufunc(
-        apply_fit,
+        _vectorize_in_parallel(apply_fit, n_jobs) if parallel else apply_fit,
         da[dim],
         da,
         amp_guess,
         freq_guess,
-        0,
-        0.5,
+        phi_guess,
+        offset_guess,
         decay_guess,
         input_core_dims=[[dim], [dim], [], [], [], [], []],
         output_core_dims=[["fit_vals"]],
-        vectorize=True,
+        vectorize=not parallel,
     )
     return fit_res.assign_coords(
         fit_vals=(